@@ -1,13 +1,40 @@
-from flask import Flask, render_template, request, jsonify, send_file, send_from_directory
+from flask import Flask, Response, render_template, request, jsonify, send_from_directory
+from flask.json.provider import JSONProvider
+import orjson
 import requests
-import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
 from itertools import islice
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import io
+import csv
+import re
+import math
+import threading
 import os
 from datetime import datetime
 
+# Serialize JSON with orjson, which is much faster than the stdlib encoder
+# on the large result lists returned by /extract
+class OrjsonProvider(JSONProvider):
+    options = orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=self.options).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, option=self.options), mimetype="application/json"
+        )
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # Split a list into chunks of specified size
 def chunk_list(iterable, size):
@@ -18,89 +45,211 @@ def chunk_list(iterable, size):
             break
         yield chunk
 
+# Common DOI prefixes: (dx.)doi.org URLs with or without scheme, and "doi:"
+_DOI_PREFIX_RE = re.compile(r"^(?:(?:https?://)?(?:dx\.)?doi\.org/|doi:)", re.IGNORECASE)
+
 # Clean DOI strings by removing common prefixes
+@lru_cache(maxsize=8192)
 def clean_doi(doi):
-    prefixes_to_remove = [
-        "https://doi.org/",
-        "http://doi.org/",
-        "doi.org/",
-        "DOI:",
-        "doi:",
-        "https://dx.doi.org/",
-        "http://dx.doi.org/",
-    ]
-
-    cleaned_doi = doi.strip()
-    for prefix in prefixes_to_remove:
-        if cleaned_doi.startswith(prefix):
-            cleaned_doi = cleaned_doi[len(prefix) :]
-            break
-
-    return cleaned_doi
-
-# Fetch publication metadata from OpenAlex API with retry mechanism
-def get_publication_data(dois, retries=3, delay=5):
-    all_results = []
-    cleaned_dois = [clean_doi(doi) for doi in dois]
-    
-    for chunk in chunk_list(cleaned_dois, 50):
-        pipe_separated_dois = "|".join(chunk)
-        url = f"https://api.openalex.org/works?filter=doi:{pipe_separated_dois}&per-page=50"
-
-        for attempt in range(retries):
-            try:
-                response = requests.get(url, timeout=10)
-                if response.status_code == 200:
-                    results = response.json().get("results", [])
-                    all_results.extend(results)
-                    break
-                else:
-                    time.sleep(delay)
-            except requests.exceptions.RequestException as e:
-                time.sleep(delay)
-
-    return all_results
-
-# Extract grant information from publication data safely
-def extract_grants(publication):
-    grants_extracted = []
-    grants_data = publication.get("grants", [])
+    return _DOI_PREFIX_RE.sub("", doi.strip(), count=1)
+
+# Extract the bare DOI from an OpenAlex DOI URL
+@lru_cache(maxsize=8192)
+def extract_doi_from_url(doi_url):
+    if not doi_url:
+        return ""
+    return (
+        doi_url.replace("https://doi.org/", "")
+        if doi_url.startswith("https://doi.org/")
+        else doi_url
+    )
 
-    if not isinstance(grants_data, list):
-        return grants_extracted
+# HTTP session per thread so chunk requests reuse pooled keep-alive connections
+# without sharing one pool between server and fetch threads; retries with
+# backoff on throttling and server errors are handled by urllib3. Retry-After
+# is deliberately ignored there, since urllib3 would sleep the full window
+# (hours, on some versions without limit); throttle applies it, capped, instead
+_thread_local = threading.local()
+
+def get_session():
+    session = getattr(_thread_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        session.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=16,
+                pool_maxsize=16,
+                max_retries=Retry(
+                    total=3,
+                    backoff_factor=0.5,
+                    status_forcelist=[429, 500, 502, 503, 504],
+                    respect_retry_after_header=False,
+                    raise_on_status=False,
+                ),
+            ),
+        )
+        _thread_local.session = session
+    return session
 
-    for grant in grants_data:
-        if not isinstance(grant, dict):
-            continue
+# Pause before next chunk when OpenAlex reports fewer requests left than this
+RATE_LIMIT_THRESHOLD = 5
 
-        funder_info = grant.get("funder", {})
-        if not isinstance(funder_info, dict):
-            continue
+# Upper bound in seconds on any wait derived from OpenAlex rate limit headers
+RATE_LIMIT_MAX_WAIT = 5.0
 
-        grants_extracted.append(
-            {
-                "funder": funder_info.get("display_name", None),
-                "funder_id": funder_info.get("id", None),
-                "award_id": grant.get("award_id", None),
-            }
-        )
+# Parse a Retry-After style header into a wait in seconds, capped and non-negative
+def parse_wait_seconds(value):
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError, OverflowError):
+        return 0.0
+    if math.isnan(seconds):
+        return 0.0
+    return min(max(seconds, 0.0), RATE_LIMIT_MAX_WAIT)
+
+# OpenAlex rate limits the whole client, so every fetch thread in the process
+# waits for the same deadline (a time.monotonic() value) before its next call
+_rate_limit_not_before = 0.0
+_RATE_LIMIT_LOCK = threading.Lock()
+
+# Push back when the process may next call OpenAlex, from the rate limit
+# headers; nothing sleeps here, so the current chunk's results return at once
+def throttle(response):
+    global _rate_limit_not_before
+    headers = response.headers
+
+    # After urllib3 gave up retrying, hold the next chunk back for Retry-After
+    # (capped) so it does not run straight into the same limit
+    if response.status_code != 200:
+        wait = parse_wait_seconds(headers.get("retry-after"))
+    else:
+        try:
+            remaining = int(headers.get("x-ratelimit-remaining", RATE_LIMIT_THRESHOLD))
+        except (ValueError, OverflowError):
+            return
+        wait = 1.0 if remaining < RATE_LIMIT_THRESHOLD else 0.0
+
+    if wait > 0:
+        with _RATE_LIMIT_LOCK:
+            _rate_limit_not_before = max(
+                _rate_limit_not_before, time.monotonic() + wait
+            )
+
+# Sleep until the deadline recorded by throttle has passed
+def wait_for_rate_limit():
+    with _RATE_LIMIT_LOCK:
+        delay = _rate_limit_not_before - time.monotonic()
+    if delay > 0:
+        time.sleep(min(delay, RATE_LIMIT_MAX_WAIT))
+
+# DOIs per OpenAlex request; the API accepts at most 100 values in an OR filter
+CHUNK_SIZE = 100
+
+# Only the work fields used by extract_publication_data, to keep payloads small
+OPENALEX_SELECT_FIELDS = ",".join([
+    "id",
+    "title",
+    "display_name",
+    "authorships",
+    "doi",
+    "publication_date",
+    "publication_year",
+    "type",
+    "language",
+    "primary_location",
+    "open_access",
+    "cited_by_count",
+    "keywords",
+    "grants",
+])
+
+# Fetch a single chunk of DOIs from OpenAlex
+def fetch_chunk(chunk):
+    pipe_separated_dois = "|".join(chunk)
+    url = (
+        f"https://api.openalex.org/works?filter=doi:{pipe_separated_dois}"
+        f"&per-page={CHUNK_SIZE}&select={OPENALEX_SELECT_FIELDS}"
+    )
 
-    return grants_extracted
+    wait_for_rate_limit()
 
-# Extract keywords as a list of display names
-def extract_keywords(publication):
-    kw_data = publication.get("keywords", [])
-    if not isinstance(kw_data, list):
-        return []
+    try:
+        response = get_session().get(url, timeout=10)
+        throttle(response)
+        if response.status_code == 200:
+            return response.json().get("results", [])
+    except requests.exceptions.RequestException:
+        pass
+
+    return []
+
+# Process-wide cache of OpenAlex works keyed by lowercase DOI; metadata is
+# near-static, so repeat lookups skip the network entirely
+_DOI_CACHE = {}
+_DOI_CACHE_MAXSIZE = 10000
+_DOI_CACHE_LOCK = threading.Lock()
+
+# Chunks a single request may have in flight at once
+FETCH_CONCURRENCY_PER_REQUEST = 4
+
+# Request threads per gunicorn worker; Procfile and Dockerfile pass the same
+# GUNICORN_THREADS value to gunicorn's --threads
+REQUEST_THREADS = int(os.environ.get("GUNICORN_THREADS", 4))
+
+# Long-lived pool shared by all requests so its threads keep their sessions
+# (and connections) alive; sized so every request thread can have its full
+# share in flight, so a large request never starves concurrent ones. This caps
+# in-flight OpenAlex calls per process (16 by default), not across workers.
+_FETCH_EXECUTOR = ThreadPoolExecutor(
+    max_workers=REQUEST_THREADS * FETCH_CONCURRENCY_PER_REQUEST
+)
+
+# Fetch publication metadata from OpenAlex API, a few chunks at a time
+def get_publication_data(dois):
+    doi_keys = list(dict.fromkeys(clean_doi(doi).lower() for doi in dois))
+
+    # Snapshot cached works now so a concurrent eviction cannot drop them
+    with _DOI_CACHE_LOCK:
+        cached = {doi: _DOI_CACHE[doi] for doi in doi_keys if doi in _DOI_CACHE}
+    to_fetch = [doi for doi in doi_keys if doi not in cached]
+
+    # Submit chunks only as this request's slots free up, rather than queueing
+    # them all on the shared pool at once
+    slots = threading.BoundedSemaphore(FETCH_CONCURRENCY_PER_REQUEST)
+    futures = []
+    for chunk in chunk_list(to_fetch, CHUNK_SIZE):
+        slots.acquire()
+        future = _FETCH_EXECUTOR.submit(fetch_chunk, chunk)
+        future.add_done_callback(lambda _: slots.release())
+        futures.append(future)
+    chunk_results = [future.result() for future in futures]
+
+    fetched = {}
+    for results in chunk_results:
+        for publication in results:
+            doi = (publication.get("doi") or "").removeprefix("https://doi.org/")
+            fetched.setdefault(doi.lower(), []).append(publication)
+
+    # Only works whose DOI matches a requested key are cached; any others
+    # OpenAlex returned are still passed through after them
+    requested = set(doi_keys)
+    matched = {doi: works for doi, works in fetched.items() if doi in requested}
 
-    keywords_list = []
-    for kw in kw_data:
-        if isinstance(kw, dict):
-            display_name = kw.get("display_name")
-            if display_name:
-                keywords_list.append(display_name)
+    all_results = []
+    for doi in doi_keys:
+        all_results.extend(matched.get(doi) or cached.get(doi, []))
+    for doi, works in fetched.items():
+        if doi not in requested:
+            all_results.extend(works)
+
+    # Evict oldest entries first once the cache is full
+    with _DOI_CACHE_LOCK:
+        _DOI_CACHE.update(matched)
+        while len(_DOI_CACHE) > _DOI_CACHE_MAXSIZE:
+            del _DOI_CACHE[next(iter(_DOI_CACHE))]
 
-    return keywords_list
+    return all_results
 
 # Extract venue information from publication data
 def extract_venue_info(publication):
@@ -123,6 +272,32 @@ def extract_venue_info(publication):
     
     return venue_name
 
+# Output columns, in the order of the original CSV format
+COLUMN_ORDER = [
+    "id",
+    "title",
+    "display_name",
+    "all_authors",
+    "all_orcids",
+    "all_affiliations",
+    "all_countries",
+    "doi",
+    "publication_date",
+    "publication_year",
+    "type",
+    "language",
+    "venue",
+    "open_access",
+    "open_access_status",
+    "open_access_url",
+    "cited_by_count",
+    "keywords",
+    "grants",
+]
+
+# Placeholder row for DOIs that OpenAlex returned no work for
+_NA_TEMPLATE = {col: "N/A" for col in COLUMN_ORDER}
+
 # Country code to country name mapping
 COUNTRY_CODE_TO_NAME = {
     "US": "USA",
@@ -152,168 +327,92 @@ def extract_publication_data(publication_data):
         if not isinstance(authorships, list):
             continue
 
-        keywords_list = extract_keywords(publication)
         venue_name = extract_venue_info(publication)
 
-        all_authors = []
-        all_affiliations = []
-        all_countries = []
-        all_orcids = []
-
-        for author in authorships:
-            author_info = author.get("author", {})
-            author_name = author_info.get("display_name", None)
-            if author_name:
-                all_authors.append(author_name)
-            orcid = author_info.get("orcid", "") or ""
-            all_orcids.append(orcid)
-
-            author_affiliation = ""
-            author_country = ""
-
-            institution_info = author.get("institutions")
-            if (
-                institution_info
-                and isinstance(institution_info, list)
-                and len(institution_info) > 0
-            ):
-                primary_inst = institution_info[0]
-                if isinstance(primary_inst, dict):
-                    aff = primary_inst.get("display_name")
-                    if aff:
-                        author_affiliation = aff
-
-                    ctry_code = primary_inst.get("country_code")
-                    if ctry_code:
-                        ctry_name = COUNTRY_CODE_TO_NAME.get(ctry_code, ctry_code)
-                        author_country = ctry_name
-
-            all_affiliations.append(author_affiliation)
-            all_countries.append(author_country)
-
-        publication_row = {
+        author_infos = [author.get("author") or {} for author in authorships]
+        all_authors = [
+            info["display_name"] for info in author_infos if info.get("display_name")
+        ]
+        all_orcids = [info.get("orcid") or "" for info in author_infos]
+
+        # Affiliation and country come from each author's first institution
+        institutions = [author.get("institutions") or [{}] for author in authorships]
+        primary_insts = [
+            insts[0] if isinstance(insts, list) and isinstance(insts[0], dict) else {}
+            for insts in institutions
+        ]
+        all_affiliations = [inst.get("display_name") or "" for inst in primary_insts]
+        country_codes = [inst.get("country_code") or "" for inst in primary_insts]
+        all_countries = [COUNTRY_CODE_TO_NAME.get(code, code) for code in country_codes]
+
+        keywords_str = "; ".join(
+            kw["display_name"]
+            for kw in publication.get("keywords") or []
+            if isinstance(kw, dict) and kw.get("display_name")
+        )
+
+        funders = (
+            grant.get("funder") or {}
+            for grant in publication.get("grants") or []
+            if isinstance(grant, dict)
+        )
+        grants_str = "; ".join(
+            funder["display_name"]
+            for funder in funders
+            if isinstance(funder, dict) and funder.get("display_name")
+        )
+
+        open_access = publication.get("open_access", {})
+
+        publication_rows.append({
             "id": publication.get("id", None),
             "title": publication.get("title", None),
             "display_name": publication.get("display_name", None),
-            "all_authors": "; ".join(all_authors) if all_authors else "",
-            "all_orcids": "; ".join(all_orcids) if all_orcids else "",
-            "all_affiliations": "; ".join(all_affiliations) if all_affiliations else "",
-            "all_countries": "; ".join(all_countries) if all_countries else "",
+            "all_authors": "; ".join(all_authors),
+            "all_orcids": "; ".join(all_orcids),
+            "all_affiliations": "; ".join(all_affiliations),
+            "all_countries": "; ".join(all_countries),
             "doi": publication.get("doi", None),
             "publication_date": publication.get("publication_date", None),
             "publication_year": publication.get("publication_year", None),
             "type": publication.get("type", None),
             "language": publication.get("language", None),
             "venue": venue_name,
-            "open_access": publication.get("open_access", {}).get("is_oa", None),
-            "open_access_status": publication.get("open_access", {}).get("oa_status", None),
-            "open_access_url": publication.get("open_access", {}).get("oa_url", None),
+            "open_access": open_access.get("is_oa", None),
+            "open_access_status": open_access.get("oa_status", None),
+            "open_access_url": open_access.get("oa_url", None),
             "cited_by_count": publication.get("cited_by_count", None),
-            "keywords": "; ".join(keywords_list) if keywords_list else "",
-            "grants": (
-                "; ".join(
-                    [
-                        grant.get("funder", "")
-                        for grant in extract_grants(publication)
-                        if grant.get("funder")
-                    ]
-                )
-                if extract_grants(publication)
-                else ""
-            ),
-        }
-
-        publication_rows.append(publication_row)
+            "keywords": keywords_str,
+            "grants": grants_str,
+        })
 
     return publication_rows
 
-# Order DataFrame according to original DOI list and handle missing entries
-def order_by_doi_sequence(df, original_dois):
+# Order records according to original DOI list and handle missing entries
+def order_by_doi_sequence(records, original_dois):
     cleaned_original_dois = [clean_doi(doi) for doi in original_dois]
 
-    if df.empty:
-        na_rows = [
-            {
-                "id": "N/A",
-                "title": "N/A",
-                "display_name": "N/A",
-                "all_authors": "N/A",
-                "all_orcids": "N/A",
-                "all_affiliations": "N/A",
-                "all_countries": "N/A",
-                "doi": f"https://doi.org/{doi}",
-                "publication_date": "N/A",
-                "publication_year": "N/A",
-                "type": "N/A",
-                "language": "N/A",
-                "venue": "N/A",
-                "open_access": "N/A",
-                "open_access_status": "N/A",
-                "open_access_url": "N/A",
-                "cited_by_count": "N/A",
-                "keywords": "N/A",
-                "grants": "N/A",
-            }
-            for doi in cleaned_original_dois
-        ]
-        return pd.DataFrame(na_rows)
-
-    def extract_doi_from_url(doi_url):
-        if pd.isna(doi_url) or not doi_url:
-            return ""
-        return (
-            doi_url.replace("https://doi.org/", "")
-            if doi_url.startswith("https://doi.org/")
-            else doi_url
-        )
+    # DOIs are case-insensitive and OpenAlex returns them lowercased, so
+    # compare lowercase keys on both sides
+    found_dois = set(extract_doi_from_url(record["doi"]).lower() for record in records)
 
-    found_dois = set(extract_doi_from_url(doi) for doi in df["doi"])
-
-    missing_dois = [doi for doi in cleaned_original_dois if doi not in found_dois]
+    missing_dois = [
+        doi for doi in cleaned_original_dois if doi.lower() not in found_dois
+    ]
 
     na_rows = [
-        {
-            "id": "N/A",
-            "title": "N/A",
-            "display_name": "N/A",
-            "all_authors": "N/A",
-            "all_orcids": "N/A",
-            "all_affiliations": "N/A",
-            "all_countries": "N/A",
-            "doi": f"https://doi.org/{doi}",
-            "publication_date": "N/A",
-            "publication_year": "N/A",
-            "type": "N/A",
-            "language": "N/A",
-            "venue": "N/A",
-            "open_access": "N/A",
-            "open_access_status": "N/A",
-            "open_access_url": "N/A",
-            "cited_by_count": "N/A",
-            "keywords": "N/A",
-            "grants": "N/A",
-        }
-        for doi in missing_dois
+        {**_NA_TEMPLATE, "doi": f"https://doi.org/{doi}"} for doi in missing_dois
     ]
 
-    df_with_na = (
-        pd.concat([df, pd.DataFrame(na_rows)], ignore_index=True) if na_rows else df
-    )
-
-    doi_to_order = {doi: i for i, doi in enumerate(cleaned_original_dois)}
-
-    df_with_na["doi_order"] = df_with_na["doi"].apply(
-        lambda x: doi_to_order.get(extract_doi_from_url(x), 999999)
-    )
+    doi_to_order = {doi.lower(): i for i, doi in enumerate(cleaned_original_dois)}
 
-    df_ordered = (
-        df_with_na.sort_values("doi_order")
-        .drop(columns=["doi_order"])
-        .reset_index(drop=True)
+    return sorted(
+        records + na_rows,
+        key=lambda record: doi_to_order.get(
+            extract_doi_from_url(record["doi"]).lower(), 999999
+        ),
     )
 
-    return df_ordered
-
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -341,34 +440,27 @@ def extract_metadata():
         if not cleaned_dois:
             return jsonify({'error': 'No valid DOIs found'}), 400
         
-        # Fetch publication data
-        publication_data = get_publication_data(cleaned_dois)
+        # Fetch publication data once per unique DOI; ordering below still
+        # follows the full input list so repeated DOIs stay aligned
+        unique_dois = list(dict.fromkeys(cleaned_dois))
+        publication_data = get_publication_data(unique_dois)
         
-        if not publication_data:
-            # Create N/A rows for all DOIs
-            df_final = order_by_doi_sequence(pd.DataFrame(), cleaned_dois)
-        else:
-            records = extract_publication_data(publication_data)
-            df = pd.DataFrame(records)
-            
-            # Remove duplicates
-            seen_ids = set()
-            indices_to_keep = [
-                i
-                for i, pub_id in enumerate(df["id"])
-                if not (pub_id in seen_ids or seen_ids.add(pub_id))
-            ]
-            
-            df_deduplicated = df.iloc[indices_to_keep].reset_index(drop=True)
-            df_final = order_by_doi_sequence(df_deduplicated, cleaned_dois)
+        records = extract_publication_data(publication_data)
+        
+        # Remove duplicates
+        seen_ids = set()
+        records = [
+            record
+            for record in records
+            if not (record["id"] in seen_ids or seen_ids.add(record["id"]))
+        ]
         
-        # Convert to JSON for preview
-        results = df_final.to_dict('records')
+        results = order_by_doi_sequence(records, cleaned_dois)
         
         return jsonify({
             'success': True,
             'results': results,
-            'total_publications': len(df_final),
+            'total_publications': len(results),
             'message': f'Successfully processed {len(cleaned_dois)} DOIs'
         })
         
@@ -384,47 +476,44 @@ def download_csv():
         if not results:
             return jsonify({'error': 'No data to download'}), 400
         
-        # Create DataFrame and CSV
-        df = pd.DataFrame(results)
-        
-        # Ensure exact column order matching the original CSV format
-        column_order = [
-            'id', 'title', 'display_name', 'all_authors', 'all_orcids', 'all_affiliations',
-            'all_countries', 'doi', 'publication_date', 'publication_year',
-            'type', 'language', 'venue', 'open_access', 'open_access_status',
-            'open_access_url', 'cited_by_count', 'keywords', 'grants'
-        ]
-        
-        # Reorder columns and fill any missing columns with N/A
-        for col in column_order:
-            if col not in df.columns:
-                df[col] = 'N/A'
-        
-        df = df[column_order]
-        
-        # Create CSV in memory
-        output = io.StringIO()
-        df.to_csv(output, index=False)
-        output.seek(0)
+        # Rows are written after the response starts, so reject bad input now
+        if not isinstance(results, list) or not all(isinstance(row, dict) for row in results):
+            return jsonify({'error': 'Results must be a list of objects'}), 400
         
         # Generate filename with timestamp
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         filename = f"publication_metadata_{timestamp}.csv"
         
-        # Create response
-        response = io.BytesIO()
-        response.write(output.getvalue().encode('utf-8'))
-        response.seek(0)
+        # Stream the CSV row by row in the original column order, filling
+        # any missing fields with N/A
+        def generate():
+            buffer = io.StringIO()
+            writer = csv.DictWriter(
+                buffer,
+                fieldnames=COLUMN_ORDER,
+                restval='N/A',
+                extrasaction='ignore',
+                lineterminator='\n'
+            )
+            
+            writer.writeheader()
+            yield buffer.getvalue()
+            
+            for row in results:
+                buffer.seek(0)
+                buffer.truncate()
+                writer.writerow(row)
+                yield buffer.getvalue()
         
-        return send_file(
-            response,
+        return Response(
+            generate(),
             mimetype='text/csv',
-            as_attachment=True,
-            download_name=filename
+            headers={'Content-Disposition': f'attachment; filename={filename}'}
         )
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Development server only; production runs under gunicorn (see Procfile)
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5001)
+    app.run(debug=os.environ.get('FLASK_DEBUG') == '1', host='0.0.0.0', port=5001)